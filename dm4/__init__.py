@@ -6,10 +6,13 @@ Pure Python reader for Gatan Digital Micrograph 4 (DM4) files, providing access
 1.0.3 DM4TagDir is now imported with dm4 module to simplify typing.
       Invoking the dm4 module as a script now prints the tag directory tree of a passed DM4 file.
       Removed dependency on the six module
+1.0.4 Added validate_dm4 to check files for truncation or corruption without reading tag data, returning a report
+      instead of raising.  python -m dm4 --validate checks many files in parallel.
 """
 
-__version__ = "1.0.3.post1"
+__version__ = "1.0.4"
 
 from dm4.headers import DM4DataType, DM4DirHeader, DM4Header, DM4TagHeader, DM4Config, DM4TagDir, format_config
 from dm4.dm4file import DM4File
 from dm4.helpers import print_tag_directory_tree, print_tag_data
+from dm4.validate import DM4ValidationIssue, DM4ValidationReport, validate_dm4, validate_dm4_buffer
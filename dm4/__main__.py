@@ -3,19 +3,88 @@ Created on Sep 12, 2013
 
 @author: u0490822
 """
+from __future__ import annotations
 import sys
+import argparse
+import json
+import concurrent.futures
 from dm4.dm4file import DM4File
 from dm4.helpers import print_tag_directory_tree, print_tag_data
+from dm4.validate import DM4ValidationIssue, DM4ValidationReport, validate_dm4
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return number
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m dm4',
+        description="Invoking dm4 as a module prints the tag directory tree of a Digital Micrograph 4 (DM4) file.")
+    parser.add_argument('paths', metavar='dm4_input_fullpath', nargs='+',
+                        help="DM4 file to read.  Multiple files may be passed with --validate")
+    parser.add_argument('--validate', action='store_true',
+                        help="Check the structure of each file for truncation or corruption instead of printing tags")
+    parser.add_argument('-j', '--jobs', type=_positive_int, default=None,
+                        help="Number of files to validate in parallel, defaults to the number of processors")
+    parser.add_argument('--json', action='store_true',
+                        help="Print validation reports as JSON, one object per line")
+    return parser
+
+
+def _print_report(report: DM4ValidationReport, as_json: bool):
+    if as_json:
+        report_dict = report._asdict()
+        report_dict['valid'] = report.valid
+        report_dict['issues'] = [issue._asdict() for issue in report.issues]
+        report_dict['warnings'] = [warning._asdict() for warning in report.warnings]
+        print(json.dumps(report_dict))
+        return
+
+    print('%s\t%s' % ('OK' if report.valid else 'FAILED', report.filename))
+    for issue in report.issues:
+        print('\t%d\t%s\t%s' % (issue.offset, issue.path, issue.message))
+    for warning in report.warnings:
+        print('\tWARNING\t%d\t%s\t%s' % (warning.offset, warning.path, warning.message))
+
+
+def validate_files(paths: list[str], jobs: int | None = None, as_json: bool = False) -> bool:
+    """Validate the passed files in parallel and print a report for each.
+    :return: True if all files are valid"""
+    all_valid = True
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(validate_dm4, path) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                report = future.result()
+            except Exception as e:
+                # A crashed worker should fail its own file, not the rest of the batch
+                report = DM4ValidationReport(path, 0, 0, 0, [
+                    DM4ValidationIssue(0, '', "Unable to validate file: %s: %s" % (type(e).__name__, e))], [])
+
+            _print_report(report, as_json)
+            all_valid = all_valid and report.valid
+
+    return all_valid
 
 
 def main():
-    if len(sys.argv) < 2 or len(sys.argv) > 2:
-        print("Usage: python -m dm4 <dm4_input_fullpath>")
-        print()
-        print("Invoking dm4 as a module prints the tag directory tree of a Digital Micrograph 4 (DM4) file.")
-        sys.exit(1)
+    parser = _create_parser()
+    args = parser.parse_args()
+
+    if args.validate:
+        sys.exit(0 if validate_files(args.paths, args.jobs, args.json) else 1)
+
+    if args.jobs is not None or args.json:
+        parser.error("-j/--jobs and --json may only be used with --validate")
+
+    if len(args.paths) > 1:
+        parser.error("Only one file may be printed at a time")
 
-    dm4_input_fullpath = sys.argv[1]
+    dm4_input_fullpath = args.paths[0]
 
     with DM4File.open(dm4_input_fullpath) as dm4file:
         tags = dm4file.read_directory()
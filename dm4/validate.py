@@ -0,0 +1,368 @@
+"""
+Integrity checks for DM4 files.
+
+The validator walks the tag directory tree using only the tag headers and seeks past tag payloads using each tag's
+byte_length, so the image data is never read.  Instead of raising on the first problem found it returns a
+DM4ValidationReport listing every inconsistency it could detect before the structure became unreadable.
+"""
+from __future__ import annotations
+import mmap
+import os
+import struct
+from typing import NamedTuple, Optional, Union
+
+import dm4
+
+_TAG_TYPE_DIRECTORY = 20
+_TAG_TYPE_DATA = 21
+_TAG_TYPE_END = 0
+
+_DATA_TYPE_GROUP = 15
+_DATA_TYPE_STRING = 18
+_DATA_TYPE_ARRAY = 20
+
+_VERIFICATION_STR = b'%%%%'
+_INFO_HEAD_LENGTH = 4  # Data info entries read before the info length is checked, and shown in messages
+_END_PADDING = b'\x00' * 8  # A DM4 file ends with 8 zero bytes after the root directory
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class DM4ValidationIssue(NamedTuple):
+    """A single inconsistency found while validating a DM4 file"""
+    offset: int  # Byte offset in the file where the problem was detected
+    path: str  # Slash separated path of the tag or directory, unnamed entries are written as [index]
+    message: str
+
+
+class DM4ValidationReport(NamedTuple):
+    """Result of validating a DM4 file"""
+    filename: Optional[str]
+    file_size: int
+    num_dirs: int  # Number of tag directories walked, including the root directory
+    num_tags: int  # Number of data tags walked
+    issues: list[DM4ValidationIssue]
+    warnings: list[DM4ValidationIssue]  # Tags whose data types the validator cannot size, these do not affect valid
+
+    @property
+    def valid(self) -> bool:
+        """True if no issues were found.  Warnings are not considered."""
+        return len(self.issues) == 0
+
+
+class _ScanAborted(Exception):
+    """Raised internally when the file structure cannot be followed any further"""
+    pass
+
+
+class _OpenDirectory:
+    """A directory on the scanner's stack whose tags have not all been scanned"""
+
+    def __init__(self, path: str, num_tags: int, tag_offset: int, data_offset: int, byte_length: int):
+        self.path = path
+        self.num_tags = num_tags
+        self.next_tag = 0
+        self.tag_offset = tag_offset  # Offset reported if the directory byte length is wrong
+        self.data_offset = data_offset  # Offset of the sorted flag, the byte length is measured from here
+        self.byte_length = byte_length
+
+
+class _Scanner:
+    """Walks the tag tree of a DM4 file held in a buffer, recording issues as it goes"""
+
+    def __init__(self, buffer: Buffer):
+        self.buffer = buffer
+        self.file_size = len(buffer)
+        self.num_dirs = 0
+        self.num_tags = 0
+        self.issues = []  # type: list[DM4ValidationIssue]
+        self.warnings = []  # type: list[DM4ValidationIssue]
+        self.location = (0, '')  # Offset and path of the tag being scanned, reported if the scanner fails
+
+    def add_issue(self, offset: int, path: str, message: str):
+        self.issues.append(DM4ValidationIssue(offset, path, message))
+
+    def add_warning(self, offset: int, path: str, message: str):
+        self.warnings.append(DM4ValidationIssue(offset, path, message))
+
+    def abort(self, offset: int, path: str, message: str):
+        self.add_issue(offset, path, message)
+        raise _ScanAborted()
+
+    def unpack(self, format_str: str, offset: int, path: str) -> tuple:
+        """Unpack a value, aborting the scan if it lies past the end of the file"""
+        if offset + struct.calcsize(format_str) > self.file_size:
+            self.abort(offset, path, "Unexpected end of file, the file appears to be truncated")
+
+        return struct.unpack_from(format_str, self.buffer, offset)
+
+    def scan(self):
+        header_size = dm4.format_config.header_size
+        root_size = dm4.format_config.root_tag_dir_header_size
+
+        if self.file_size < header_size + root_size:
+            self.abort(0, '', "File is %d bytes, too short to contain a DM4 header" % self.file_size)
+
+        (version, root_length, byteorder) = struct.unpack_from('>IQI', self.buffer, 0)
+        if version != 4:
+            self.abort(0, '', "File version is %d, expected 4.  The file is not in DM4 format" % version)
+
+        if byteorder not in (0, 1):
+            self.add_issue(12, '', "Invalid byte order flag %d" % byteorder)
+
+        declared_size = header_size + root_length + len(_END_PADDING)
+        if declared_size > self.file_size:
+            self.add_issue(4, '', "Header declares a file of %d bytes but the file is only %d bytes long, "
+                                  "the file appears to be truncated" % (declared_size, self.file_size))
+
+        num_tags = self.read_directory_header(header_size, '')
+        root = _OpenDirectory('', num_tags, 4, header_size, root_length)
+        end = self.scan_directories(root, header_size + root_size)
+
+        if self.buffer[end:end + len(_END_PADDING)] != _END_PADDING:
+            self.add_issue(end, '', "Expected %d zero bytes after the root directory" % len(_END_PADDING))
+        elif end + len(_END_PADDING) < self.file_size:
+            self.add_issue(end + len(_END_PADDING), '', "%d unexpected bytes follow the end of the file" %
+                           (self.file_size - end - len(_END_PADDING)))
+
+    def read_directory_header(self, offset: int, path: str) -> int:
+        """Check the sorted and closed flags of a directory.
+        :return: Number of tags in the directory"""
+        (issorted, isclosed, num_tags) = self.unpack('>BBQ', offset, path)
+        if issorted not in (0, 1):
+            self.add_issue(offset, path, "Invalid sorted flag %d" % issorted)
+        if isclosed not in (0, 1):
+            self.add_issue(offset + 1, path, "Invalid closed flag %d" % isclosed)
+
+        return num_tags
+
+    def close_directory(self, directory: _OpenDirectory, end: int):
+        """Check the directory byte length against the offset its contents ended at"""
+        if end != directory.data_offset + directory.byte_length:
+            self.add_issue(directory.tag_offset, directory.path,
+                           "Directory byte length is %d but its contents occupy %d bytes" %
+                           (directory.byte_length, end - directory.data_offset))
+
+    def scan_directories(self, root: _OpenDirectory, offset: int) -> int:
+        """Scan the tags of the root directory and all subdirectories, starting at offset.  An explicit stack is used
+        instead of recursion so deeply nested files cannot exhaust the interpreter's recursion limit.
+        :return: Offset of the first byte after the root directory contents"""
+        stack = [root]
+        self.num_dirs += 1
+
+        while stack:
+            directory = stack[-1]
+            if directory.next_tag == directory.num_tags:
+                self.close_directory(stack.pop(), offset)
+                continue
+
+            iTag = directory.next_tag
+            directory.next_tag += 1
+            path = directory.path
+
+            if offset >= self.file_size:
+                self.abort(offset, path, "Directory declares %d tags but the file ends after %d" %
+                           (directory.num_tags, iTag))
+
+            tag_type = self.buffer[offset]
+            if tag_type == _TAG_TYPE_END:
+                self.add_issue(offset, path, "Directory declares %d tags but an end marker was found after %d" %
+                               (directory.num_tags, iTag))
+                offset += 1
+                self.close_directory(stack.pop(), offset)
+                continue
+
+            tag_offset = offset
+            self.location = (tag_offset, path)
+            name_length = self.unpack('>H', offset + 1, path)[0]
+            name_end = offset + 3 + name_length
+            if name_length > 0:
+                if name_end > self.file_size:
+                    self.abort(offset, path, "Unexpected end of file, the file appears to be truncated")
+
+                name = bytes(self.buffer[offset + 3:name_end]).decode('utf-8', errors='ignore')
+            else:
+                name = '[%d]' % iTag
+
+            tag_path = path + '/' + name if path else name
+            self.location = (tag_offset, tag_path)
+            byte_length = self.unpack('>Q', name_end, tag_path)[0]
+            data_offset = name_end + 8
+
+            if tag_type == _TAG_TYPE_DIRECTORY:
+                child_num_tags = self.read_directory_header(data_offset, tag_path)
+                stack.append(_OpenDirectory(tag_path, child_num_tags, tag_offset, data_offset, byte_length))
+                self.num_dirs += 1
+                offset = data_offset + dm4.format_config.root_tag_dir_header_size
+            elif tag_type == _TAG_TYPE_DATA:
+                self.scan_tag(data_offset, byte_length, tag_path)
+                offset = data_offset + byte_length
+            else:
+                self.abort(tag_offset, tag_path, "Unknown tag type %d, the tag boundary is lost" % tag_type)
+
+        return offset
+
+    def scan_tag(self, data_offset: int, byte_length: int, path: str):
+        """Check the verification string and data info of a data tag against its byte length"""
+        self.num_tags += 1
+        data_end = data_offset + byte_length
+
+        if data_end > self.file_size:
+            self.abort(data_offset, path, "Tag byte length %d extends %d bytes past the end of the file" %
+                       (byte_length, data_end - self.file_size))
+
+        if self.buffer[data_offset:data_offset + 4] != _VERIFICATION_STR:
+            self.abort(data_offset, path, "Missing %%%% verification string, tag boundaries are inconsistent")
+
+        info_length = self.unpack('>Q', data_offset + 4, path)[0]
+        info_offset = data_offset + 12
+        if info_length == 0 or info_offset + 8 * info_length > data_end:
+            self.add_issue(data_offset, path,
+                           "Tag data info length %d does not fit in tag byte length %d" % (info_length, byte_length))
+            return
+
+        # Only the leading entries are read until the info length has been checked, so a corrupt length on a large
+        # tag does not unpack the tag data as data info
+        head_length = min(info_length, _INFO_HEAD_LENGTH)
+        head = struct.unpack_from('>%dq' % head_length, self.buffer, info_offset)
+        expected_info_length = _expected_info_length(head)
+        if expected_info_length is None:
+            self.add_warning(data_offset, path,
+                             "Unrecognized tag data info %s, size not checked" % _format_info(head, info_length))
+            return
+
+        if expected_info_length != info_length:
+            self.add_issue(data_offset, path, "Tag data info length is %d but data info %s requires %d" %
+                           (info_length, _format_info(head, info_length), expected_info_length))
+            return
+
+        info = struct.unpack_from('>%dq' % info_length, self.buffer, info_offset)
+        payload_size = _payload_size(info)
+        if payload_size is None:
+            # The tag may be well formed but use a type the validator cannot size.  Its boundary is still checked by
+            # the verification string of the tag that follows.
+            self.add_warning(data_offset, path,
+                             "Unrecognized tag data info %s, size not checked" % _format_info(info, info_length))
+            return
+
+        expected_length = 12 + 8 * info_length + payload_size
+        if expected_length != byte_length:
+            self.add_issue(data_offset, path, "Tag byte length is %d but its data info describes %d bytes" %
+                           (byte_length, expected_length))
+
+
+def _data_type_size(type_code: int) -> Optional[int]:
+    data_type = dm4.format_config.data_type_dict.get(type_code)
+    return None if data_type is None else data_type.num_bytes
+
+
+def _format_info(info: tuple[int, ...], info_length: int) -> str:
+    """Format data info for a message, showing only the leading entries"""
+    shown = ', '.join(str(value) for value in info[:_INFO_HEAD_LENGTH])
+    if info_length > _INFO_HEAD_LENGTH:
+        shown += ', ... %d entries' % info_length
+    return '(%s)' % shown
+
+
+def _expected_info_length(head: tuple[int, ...]) -> Optional[int]:
+    """
+    Compute the number of data info entries implied by a tag's type code and field count.
+    :param head: Up to the first _INFO_HEAD_LENGTH entries of the data info
+    :return: The expected info length, or None if the type code is not one the validator can size
+    """
+    type_code = head[0]
+    if type_code == _DATA_TYPE_GROUP:
+        # 15, groupname length, number of fields, (fieldname length, field type) pairs
+        return 3 + 2 * head[2] if len(head) > 2 else 3
+    elif type_code == _DATA_TYPE_STRING:
+        return 2
+    elif type_code == _DATA_TYPE_ARRAY:
+        if len(head) < 2:
+            return 3
+        if head[1] == _DATA_TYPE_GROUP:
+            # 20, 15, groupname length, number of fields, (fieldname length, field type) pairs, array length
+            return 5 + 2 * head[3] if len(head) > 3 else 5
+        if head[1] in dm4.format_config.data_type_dict:
+            return 3
+        return None
+    elif type_code in dm4.format_config.data_type_dict:
+        return 1
+
+    return None
+
+
+def _group_size(field_info: tuple[int, ...]) -> Optional[int]:
+    """Size of a group given the (fieldname_length, field_type) pairs that describe it"""
+    total = 0
+    for field_type in field_info[1::2]:
+        field_size = _data_type_size(field_type)
+        if field_size is None:
+            return None
+        total += field_size
+
+    return total
+
+
+def _payload_size(info: tuple[int, ...]) -> Optional[int]:
+    """
+    Compute the number of bytes of tag data described by a tag's data info.  The info length must already have been
+    checked with _expected_info_length.
+    :return: The payload size, or None if a group field has a type the validator cannot size
+    """
+    type_code = info[0]
+    if type_code == _DATA_TYPE_GROUP:
+        return _group_size(info[3:])
+    elif type_code == _DATA_TYPE_STRING:
+        return 2 * info[1]  # UTF-16 characters
+    elif type_code == _DATA_TYPE_ARRAY:
+        if info[1] == _DATA_TYPE_GROUP:
+            group_size = _group_size(info[4:-1])
+            if group_size is None:
+                return None
+            return group_size * info[-1]
+
+        return _data_type_size(info[1]) * info[2]
+
+    return _data_type_size(type_code)
+
+
+def validate_dm4_buffer(buffer: Buffer, filename: str | None = None) -> DM4ValidationReport:
+    """
+    Validate the structure of a DM4 file that has already been loaded or memory mapped.  Tags whose data info
+    describes a type the validator cannot size, such as groups nested in groups, are reported as warnings and do not
+    make the report invalid.
+    :param buffer: Contents of the DM4 file
+    :param str filename: Optional name recorded in the report
+    """
+    scanner = _Scanner(buffer)
+    try:
+        scanner.scan()
+    except _ScanAborted:
+        pass
+    except Exception as e:
+        # Keep the promise of a report rather than an exception for inputs the scanner did not anticipate
+        (offset, path) = scanner.location
+        scanner.add_issue(offset, path, "Validator error, possibly a bug rather than file corruption: %s: %s" %
+                          (type(e).__name__, e))
+
+    return DM4ValidationReport(filename, scanner.file_size, scanner.num_dirs, scanner.num_tags, scanner.issues,
+                               scanner.warnings)
+
+
+def validate_dm4(filename: str) -> DM4ValidationReport:
+    """
+    Check a DM4 file for truncation or corruption without reading the tag data.  The file is memory mapped so only
+    the pages holding tag headers are read from disk.  Problems, including failure to open the file, are returned
+    in the report rather than raised.
+    :param str filename: Name of DM4 file to validate
+    """
+    try:
+        with open(filename, "rb") as hfile:
+            file_size = os.fstat(hfile.fileno()).st_size
+            if file_size == 0:
+                return validate_dm4_buffer(b'', filename)
+
+            with mmap.mmap(hfile.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                return validate_dm4_buffer(buffer, filename)
+    except (OSError, ValueError) as e:
+        return DM4ValidationReport(filename, 0, 0, 0, [DM4ValidationIssue(0, '', "Unable to read file: %s" % e)], [])
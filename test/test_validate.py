@@ -0,0 +1,282 @@
+"""
+Tests for the DM4 validator.  These build small synthetic DM4 files in memory so no input file is required.
+"""
+
+import unittest
+import contextlib
+import io
+import json
+import os
+import struct
+import sys
+import tempfile
+
+from dm4 import DM4File, validate_dm4, validate_dm4_buffer
+import dm4.__main__
+import dm4.validate
+
+
+def _tag_name(name: str) -> bytes:
+    encoded = name.encode('utf-8')
+    return struct.pack('>H', len(encoded)) + encoded
+
+
+def _data_tag(name: str, info: tuple, payload: bytes) -> bytes:
+    data = b'%%%%' + struct.pack('>Q', len(info)) + struct.pack('>%dq' % len(info), *info) + payload
+    return b'\x15' + _tag_name(name) + struct.pack('>Q', len(data)) + data
+
+
+def _dir_tag(name: str, tags: list, byte_length_error: int = 0) -> bytes:
+    data = b'\x00\x01' + struct.pack('>Q', len(tags)) + b''.join(tags)
+    return b'\x14' + _tag_name(name) + struct.pack('>Q', len(data) + byte_length_error) + data
+
+
+def _dm4_file(tags: list) -> bytes:
+    root = b'\x00\x01' + struct.pack('>Q', len(tags)) + b''.join(tags)
+    return struct.pack('>IQI', 4, len(root), 1) + root + b'\x00' * 8
+
+
+def _sample_file() -> bytes:
+    width = _data_tag('Width', (3,), struct.pack('<i', 4))
+    pixels = _data_tag('Data', (20, 4, 4), struct.pack('<4H', 1, 2, 3, 4))
+    origin = _data_tag('Origin', (15, 0, 2, 0, 6, 0, 6), struct.pack('<2f', 0.5, 1.5))
+    return _dm4_file([width, _dir_tag('ImageData', [pixels, origin])])
+
+
+class TestValidate(unittest.TestCase):
+
+    def test_valid_file(self):
+        data = _sample_file()
+        report = validate_dm4_buffer(data)
+        self.assertTrue(report.valid, report.issues)
+        self.assertEqual(report.num_dirs, 2)
+        self.assertEqual(report.num_tags, 3)
+
+        # The synthetic file must also be readable by DM4File for the test to be meaningful
+        dm4file = DM4File(io.BytesIO(data))
+        tags = dm4file.read_directory()
+        self.assertEqual(list(dm4file.read_tag_data(tags.named_subdirs['ImageData'].named_tags['Data'])), [1, 2, 3, 4])
+
+    def test_truncated_file(self):
+        data = _sample_file()
+        report = validate_dm4_buffer(data[:len(data) - 16])
+        self.assertFalse(report.valid)
+        self.assertEqual(report.issues[-1].path, 'ImageData/Origin')
+
+    def test_corrupt_verification_string(self):
+        data = bytearray(_sample_file())
+        offset = data.index(b'%%%%')
+        data[offset:offset + 4] = b'%%%!'
+        report = validate_dm4_buffer(data)
+        self.assertFalse(report.valid)
+        self.assertEqual(report.issues[0].offset, offset)
+        self.assertEqual(report.issues[0].path, 'Width')
+
+    def test_array_size_mismatch(self):
+        pixels = _data_tag('Data', (20, 4, 5), struct.pack('<4H', 1, 2, 3, 4))
+        report = validate_dm4_buffer(_dm4_file([pixels]))
+        self.assertFalse(report.valid)
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].path, 'Data')
+
+    def test_tag_count_mismatch(self):
+        width = _data_tag('Width', (3,), struct.pack('<i', 4))
+        root = b'\x00\x01' + struct.pack('>Q', 2) + width + b'\x00'
+        data = struct.pack('>IQI', 4, len(root), 1) + root + b'\x00' * 8
+        report = validate_dm4_buffer(data)
+        self.assertEqual(report.num_tags, 1)
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].offset, 16 + 10 + len(width))
+        self.assertIn("declares 2 tags but an end marker was found after 1", report.issues[0].message)
+
+    def test_not_dm4(self):
+        report = validate_dm4_buffer(struct.pack('>IQI', 3, 0, 1) + b'\x00' * 16)
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].offset, 0)
+        self.assertIn("File version is 3", report.issues[0].message)
+
+    def test_root_length_mismatch(self):
+        data = bytearray(_sample_file())
+        data[4:12] = struct.pack('>Q', 10)
+        report = validate_dm4_buffer(data)
+        self.assertFalse(report.valid)
+        self.assertEqual(report.issues[0].offset, 4)
+        self.assertIn("Directory byte length is 10", report.issues[0].message)
+
+    def test_trailing_bytes(self):
+        data = _sample_file()
+        report = validate_dm4_buffer(data + b'\xff' * 700)
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].offset, len(data))
+        self.assertIn("700 unexpected bytes", report.issues[0].message)
+
+    def test_missing_end_padding(self):
+        data = _sample_file()
+        report = validate_dm4_buffer(data[:-8])
+        self.assertFalse(report.valid)
+        self.assertEqual(report.issues[-1].offset, len(data) - 8)
+        self.assertIn("zero bytes after the root directory", report.issues[-1].message)
+
+    def test_invalid_closed_flag(self):
+        data = bytearray(_sample_file())
+        data[17] = 0x7f
+        report = validate_dm4_buffer(data)
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].offset, 17)
+        self.assertIn("Invalid closed flag 127", report.issues[0].message)
+
+        width = _data_tag('Width', (3,), struct.pack('<i', 4))
+        subdir = bytearray(_dir_tag('Sub', [width]))
+        subdir[1 + 2 + 3 + 8] = 0x7f  # Sorted flag follows the type, name and byte length
+        report = validate_dm4_buffer(_dm4_file([bytes(subdir)]))
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].path, 'Sub')
+        self.assertIn("Invalid sorted flag 127", report.issues[0].message)
+
+    def test_directory_byte_length_mismatch(self):
+        width = _data_tag('Width', (3,), struct.pack('<i', 4))
+        report = validate_dm4_buffer(_dm4_file([_dir_tag('Sub', [width], byte_length_error=4)]))
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].offset, 26)
+        self.assertEqual(report.issues[0].path, 'Sub')
+        self.assertIn("Directory byte length is", report.issues[0].message)
+
+    def test_deeply_nested_directories(self):
+        tag = _data_tag('Width', (3,), struct.pack('<i', 4))
+        for iDepth in range(0, sys.getrecursionlimit() + 100):
+            tag = _dir_tag('', [tag])
+        report = validate_dm4_buffer(_dm4_file([tag]))
+        self.assertTrue(report.valid, report.issues[:1])
+        self.assertEqual(report.num_tags, 1)
+
+    def test_unrecognized_data_info(self):
+        # A group whose field is itself a group cannot be sized, this is a warning rather than a failure
+        nested = _data_tag('Nested', (15, 0, 1, 0, 15), b'')
+        report = validate_dm4_buffer(_dm4_file([nested]))
+        self.assertTrue(report.valid, report.issues)
+        self.assertEqual(len(report.warnings), 1)
+        self.assertEqual(report.warnings[0].path, 'Nested')
+
+    def test_array_of_groups(self):
+        # Array of 3 groups of two 4 byte floats
+        info = (20, 15, 0, 2, 0, 6, 0, 6, 3)
+        report = validate_dm4_buffer(_dm4_file([_data_tag('Points', info, b'\x00' * 24)]))
+        self.assertTrue(report.valid, report.issues)
+        self.assertEqual(report.warnings, [])
+
+        report = validate_dm4_buffer(_dm4_file([_data_tag('Points', info, b'\x00' * 16)]))
+        self.assertEqual(len(report.issues), 1)
+        self.assertIn("data info describes %d bytes" % (12 + 8 * len(info) + 24), report.issues[0].message)
+
+    def test_corrupt_info_length(self):
+        data = bytearray(_sample_file())
+        pixels_data_offset = data.index(b'\x00\x04Data') + 2 + 4 + 8
+        data[pixels_data_offset + 4:pixels_data_offset + 12] = struct.pack('>Q', 4)
+        report = validate_dm4_buffer(data)
+        self.assertFalse(report.valid)
+        self.assertEqual(report.issues[0].offset, pixels_data_offset)
+        self.assertEqual(report.issues[0].path, 'ImageData/Data')
+        self.assertIn("Tag data info length is 4", report.issues[0].message)
+
+    def test_group_extra_info(self):
+        report = validate_dm4_buffer(_dm4_file([_data_tag('Origin', (15, 0, 1, 0, 6, 0), b'\x00' * 4)]))
+        self.assertFalse(report.valid)
+        self.assertIn("requires 5", report.issues[0].message)
+
+    def test_corrupt_info_length_large_tag(self):
+        # A corrupt info length must not cause the tag data to be unpacked as data info
+        info_length = 100000
+        pixels = bytearray(_data_tag('Data', (20, 4, info_length * 4), b'\x00' * (info_length * 8)))
+        offset = pixels.index(b'%%%%')
+        pixels[offset + 4:offset + 12] = struct.pack('>Q', info_length)
+        report = validate_dm4_buffer(_dm4_file([bytes(pixels)]))
+        self.assertFalse(report.valid)
+        self.assertLess(len(report.issues[0].message), 200)
+
+    def test_scanner_error_location(self):
+        data = _sample_file()
+        payload_size = dm4.validate._payload_size
+        dm4.validate._payload_size = None
+        try:
+            report = validate_dm4_buffer(data)
+        finally:
+            dm4.validate._payload_size = payload_size
+
+        self.assertEqual(len(report.issues), 1)
+        self.assertEqual(report.issues[0].path, 'Width')
+        self.assertEqual(report.issues[0].offset, 26)
+        self.assertIn("Validator error", report.issues[0].message)
+
+    def test_validate_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'sample.dm4')
+            with open(path, 'wb') as hfile:
+                hfile.write(_sample_file())
+
+            report = validate_dm4(path)
+            self.assertTrue(report.valid, report.issues)
+            self.assertEqual(report.filename, path)
+
+            report = validate_dm4(os.path.join(tempdir, 'missing.dm4'))
+            self.assertFalse(report.valid)
+
+
+class TestValidateCommandLine(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.valid_path = os.path.join(self.tempdir.name, 'valid.dm4')
+        self.truncated_path = os.path.join(self.tempdir.name, 'truncated.dm4')
+        with open(self.valid_path, 'wb') as hfile:
+            hfile.write(_sample_file())
+        with open(self.truncated_path, 'wb') as hfile:
+            hfile.write(_sample_file()[:-20])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_main(self, argv: list) -> tuple:
+        """Run the command line with the passed arguments, returning the exit code and stdout"""
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            old_argv = sys.argv
+            sys.argv = ['dm4'] + argv
+            try:
+                dm4.__main__.main()
+                code = 0
+            except SystemExit as e:
+                code = e.code
+            finally:
+                sys.argv = old_argv
+
+        return code, stdout.getvalue()
+
+    def test_validate_files(self):
+        code, output = self.run_main(['--validate', '-j', '2', self.valid_path, self.truncated_path])
+        self.assertEqual(code, 1)
+        lines = output.splitlines()
+        self.assertEqual(lines[0], 'OK\t' + self.valid_path)
+        self.assertEqual(lines[1], 'FAILED\t' + self.truncated_path)
+
+        code, output = self.run_main(['--validate', self.valid_path])
+        self.assertEqual(code, 0)
+
+    def test_json(self):
+        code, output = self.run_main(['--validate', '--json', self.valid_path, self.truncated_path])
+        self.assertEqual(code, 1)
+        reports = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual([report['valid'] for report in reports], [True, False])
+        self.assertEqual(reports[1]['filename'], self.truncated_path)
+        self.assertEqual(reports[1]['issues'][0]['offset'], 4)
+
+    def test_invalid_arguments(self):
+        for argv in (['--validate', '-j', '0', self.valid_path],
+                     ['--json', self.valid_path],
+                     ['-j', '2', self.valid_path],
+                     [self.valid_path, self.truncated_path]):
+            code, output = self.run_main(argv)
+            self.assertEqual(code, 2, argv)
+
+
+if __name__ == '__main__':
+    unittest.main()